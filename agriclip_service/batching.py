@@ -0,0 +1,70 @@
+"""Dynamic batching for the model service, kept free of torch so it can be tested on its own."""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+
+class MicroBatcher:
+    """Coalesces items submitted from concurrent requests into one batched call.
+
+    A single worker thread waits up to max_wait seconds (or until max_batch
+    items are pending), calls run_batch with the list of items and resolves
+    each submitter's future with its entry of the returned list. If the batched
+    call raises, the items are retried one by one so the error only reaches
+    the submitter whose item caused it.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch: int, max_wait: float):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+
+    def start(self) -> None:
+        threading.Thread(target=self._loop, name=f"batcher-{self.run_batch.__name__}", daemon=True).start()
+
+    def submit(self, item: Any) -> Future:
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _loop(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Drop requests cancelled while queued (timeouts, client disconnects); the
+            # rest are marked running so they can no longer be cancelled under us
+            pending = [(item, future) for item, future in pending if future.set_running_or_notify_cancel()]
+            if not pending:
+                continue
+            try:
+                self._run(pending)
+            except Exception as e:
+                # Nothing may kill the worker, or every later submit would hang
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run(self, pending: List[Tuple[Any, Future]]) -> None:
+        try:
+            results = self.run_batch([item for item, _ in pending])
+        except Exception as e:
+            if len(pending) == 1:
+                pending[0][1].set_exception(e)
+                return
+            # Rerun the items one at a time so only the offending request fails
+            for entry in pending:
+                self._run([entry])
+            return
+        for (_, future), result in zip(pending, results):
+            future.set_result(result)
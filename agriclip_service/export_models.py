@@ -0,0 +1,237 @@
+"""Offline export of the AgriCLIP models into optimized runtime artifacts.
+
+Artifacts are written to MODEL_DIR (AGRICLIP_MODEL_DIR, default ./models)
+and picked up automatically by main.load_models on the next start.
+
+    python export_models.py trt --calib-dir path/to/crop_images
+    python export_models.py yolo --calib-dir path/to/crop_images
+    python export_models.py int8-cpu --calib-dir path/to/crop_images
+    python export_models.py aot
+
+The yolo command additionally needs `pip install ultralytics`.
+"""
+import argparse
+import glob
+import os
+import shutil
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
+from torchvision.transforms.functional import pil_to_tensor
+
+from main import (
+    MODEL_DIR, BATCH_MAX_SIZE, EFFNET_AOT_PATHS, EFFNET_ENGINE_PATH, EFFNET_INT8_CPU_PATH, YOLO_ONNX_PATH,
+    decode_upload, letterbox, prepare_crops,
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def list_images(directory: str, limit: int) -> List[str]:
+    files = sorted(
+        f for f in glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not files:
+        raise SystemExit(f"No calibration images found in {directory}")
+    return files[:limit]
+
+
+def classifier_input(path: str) -> torch.Tensor:
+    """A 1x3x300x300 classifier row, preprocessed like a whole-image region at serving time."""
+    with open(path, "rb") as f:
+        image = decode_upload(f.read())
+    height, width = image.shape[-2:]
+    return prepare_crops(image, np.array([[0, 0, width, height]], dtype=np.int32))
+
+
+def export_trt(args: argparse.Namespace) -> None:
+    import tensorrt as trt
+
+    class MinMaxCalibrator(trt.IInt8MinMaxCalibrator):
+        def __init__(self, files: List[str], batch_size: int, cache_file: str):
+            trt.IInt8MinMaxCalibrator.__init__(self)
+            self.files = files
+            self.batch_size = batch_size
+            self.cache_file = cache_file
+            self.index = 0
+            self.device_input = torch.empty((batch_size, 3, 300, 300), device="cuda")
+
+        def get_batch_size(self) -> int:
+            return self.batch_size
+
+        def get_batch(self, names):
+            if self.index + self.batch_size > len(self.files):
+                return None
+            chunk = self.files[self.index:self.index + self.batch_size]
+            batch = torch.cat([classifier_input(f) for f in chunk])
+            self.device_input.copy_(batch)
+            self.index += self.batch_size
+            return [self.device_input.data_ptr()]
+
+        def read_calibration_cache(self):
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, "rb") as f:
+                    return f.read()
+            return None
+
+        def write_calibration_cache(self, cache) -> None:
+            with open(self.cache_file, "wb") as f:
+                f.write(cache)
+
+    if args.max_batch < BATCH_MAX_SIZE:
+        raise SystemExit(f"--max-batch must be at least {BATCH_MAX_SIZE}, the largest batch the service sends")
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    weights = EfficientNet_B3_Weights.IMAGENET1K_V1
+    model = efficientnet_b3(weights=weights).eval()
+
+    onnx_path = os.path.join(MODEL_DIR, "efficientnet_b3.onnx")
+    torch.onnx.export(
+        model,
+        (torch.randn(1, 3, 300, 300),),
+        onnx_path,
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    with open(onnx_path, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise SystemExit("ONNX parse failed:\n" + "\n".join(errors))
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.INT8)
+    config.set_flag(trt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    profile.set_shape("input", (1, 3, 300, 300), (8, 3, 300, 300), (args.max_batch, 3, 300, 300))
+    config.add_optimization_profile(profile)
+    config.set_calibration_profile(profile)
+    config.int8_calibrator = MinMaxCalibrator(
+        list_images(args.calib_dir, args.calib_count),
+        args.calib_batch,
+        os.path.join(MODEL_DIR, "efficientnet_b3_int8.calib"),
+    )
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise SystemExit("TensorRT engine build failed")
+    with open(EFFNET_ENGINE_PATH, "wb") as f:
+        f.write(serialized)
+    print(f"Wrote {EFFNET_ENGINE_PATH}")
+
+
+def export_yolo(args: argparse.Namespace) -> None:
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from ultralytics import YOLO
+
+    class LetterboxDataReader(CalibrationDataReader):
+        def __init__(self, files: List[str], input_name: str):
+            self.files = iter(files)
+            self.input_name = input_name
+
+        def get_next(self):
+            path = next(self.files, None)
+            if path is None:
+                return None
+            arr, _, _ = letterbox(pil_to_tensor(Image.open(path).convert("RGB")))
+            return {self.input_name: arr.astype(np.float32) / 255.0}
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    exported = YOLO(args.weights).export(format="onnx", imgsz=640, dynamic=True, simplify=True)
+    fp32_path = os.path.join(MODEL_DIR, "yolov8n.onnx")
+    shutil.move(exported, fp32_path)
+
+    quantize_static(
+        fp32_path,
+        YOLO_ONNX_PATH,
+        LetterboxDataReader(list_images(args.calib_dir, args.calib_count), "images"),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+    print(f"Wrote {YOLO_ONNX_PATH}")
+
+
+def export_int8_cpu(args: argparse.Namespace) -> None:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    torch.backends.quantized.engine = args.backend
+    weights = EfficientNet_B3_Weights.IMAGENET1K_V1
+    model = efficientnet_b3(weights=weights).eval()
+    example = torch.randn(1, 3, 300, 300)
+
+    # Post-training static quantization: observe activations, then convert to INT8
+    prepared = prepare_fx(model, get_default_qconfig_mapping(args.backend), (example,))
+    with torch.no_grad():
+        for path in list_images(args.calib_dir, args.calib_count):
+            prepared(classifier_input(path).cpu())
+        quantized = convert_fx(prepared)
+        traced = torch.jit.freeze(torch.jit.trace(quantized, example))
+    traced.save(EFFNET_INT8_CPU_PATH)
+    print(f"Wrote {EFFNET_INT8_CPU_PATH}")
+
+
+def export_aot(args: argparse.Namespace) -> None:
+    from torch._inductor import aoti_compile_and_package
+
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    weights = EfficientNet_B3_Weights.IMAGENET1K_V1
+    model = efficientnet_b3(weights=weights).eval()
+    # Match the runtime layout: FP16, channels_last, on CUDA
+    model = model.to("cuda", memory_format=torch.channels_last).half()
+
+    for batch_size, path in EFFNET_AOT_PATHS.items():
+        example = torch.randn(batch_size, 3, 300, 300, device="cuda", dtype=torch.float16)
+        example = example.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            ep = torch.export.export(model, (example,))
+            aoti_compile_and_package(ep, package_path=path)
+        print(f"Wrote {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    trt_parser = sub.add_parser("trt", help="Build an INT8 TensorRT engine for EfficientNet-B3")
+    trt_parser.add_argument("--calib-dir", required=True, help="Directory of representative crop images")
+    trt_parser.add_argument("--calib-count", type=int, default=1000)
+    trt_parser.add_argument("--calib-batch", type=int, default=8)
+    trt_parser.add_argument("--max-batch", type=int, default=BATCH_MAX_SIZE,
+                            help=f"Largest batch in the engine profile, at least {BATCH_MAX_SIZE}")
+    trt_parser.set_defaults(func=export_trt)
+
+    yolo_parser = sub.add_parser("yolo", help="Export YOLOv8n to ONNX and quantize it to INT8 (QDQ)")
+    yolo_parser.add_argument("--calib-dir", required=True, help="Directory of representative crop images")
+    yolo_parser.add_argument("--calib-count", type=int, default=200)
+    yolo_parser.add_argument("--weights", default="yolov8n.pt")
+    yolo_parser.set_defaults(func=export_yolo)
+
+    int8_parser = sub.add_parser("int8-cpu", help="Statically quantize EfficientNet-B3 to INT8 for CPU inference")
+    int8_parser.add_argument("--calib-dir", required=True, help="Directory of representative crop images")
+    int8_parser.add_argument("--calib-count", type=int, default=300)
+    int8_parser.add_argument("--backend", default="x86", choices=["x86", "fbgemm", "qnnpack"])
+    int8_parser.set_defaults(func=export_int8_cpu)
+
+    aot_parser = sub.add_parser("aot", help="AOT-compile FP16 EfficientNet-B3 for each batch bucket")
+    aot_parser.set_defaults(func=export_aot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,56 @@
+import ast
+import asyncio
 import io
+import logging
 import os
+import re
 import time
-from typing import List, Optional, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, List, Optional, Dict, Any, Tuple
 
+from cachetools import LRUCache
 from fastapi import FastAPI, File, UploadFile, Form, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from PIL import Image
 import numpy as np
 
 # YOLOv8 for detection
 import torch
 import torch.nn.functional as F
-from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_jpeg
+from torchvision.ops import batched_nms, box_convert, nms, roi_align
+from torchvision.transforms.v2 import functional as TF
 from torchvision.models import efficientnet_b3, EfficientNet_B3_Weights
 from torchvision.models.detection import fasterrcnn_resnet50_fpn, FasterRCNN_ResNet50_FPN_Weights
 
+from batching import MicroBatcher
 
-app = FastAPI(title="AgriCLIP Model Service", version="1.0.0")
+# TensorRT is only installed on GPU deployments
+try:
+    import tensorrt as trt
+except ImportError:
+    trt = None
+
+# onnxruntime-gpu on GPU deployments; the CPU-only onnxruntime wheel has no CUDA or TensorRT provider
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# BLAKE3 when installed, otherwise SHA-256 (hardware-accelerated on modern x86)
+try:
+    from blake3 import blake3 as content_hasher
+except ImportError:
+    from hashlib import sha256 as content_hasher
+
+
+# uvicorn configures this logger, so messages land in the service log
+logger = logging.getLogger("uvicorn.error")
+
+app = FastAPI(title="AgriCLIP Model Service", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,116 +61,516 @@ app.add_middleware(
 )
 
 
-# Lazy-loaded models
-_detector: Optional[torch.nn.Module] = None
-_effnet: Optional[torch.nn.Module] = None
-_effnet_transform = None
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.environ.get("AGRICLIP_MODEL_DIR", os.path.join(SERVICE_DIR, "models"))
+# Built offline by `python export_models.py trt`
+EFFNET_ENGINE_PATH = os.path.join(MODEL_DIR, "efficientnet_b3_int8.engine")
+# Built offline by `python export_models.py int8-cpu`; used on CPU-only hosts when AGRICLIP_INT8_CPU is set
+EFFNET_INT8_CPU_PATH = os.path.join(MODEL_DIR, "efficientnet_b3_int8.pt")
+USE_INT8_CPU = bool(os.environ.get("AGRICLIP_INT8_CPU"))
+# Fixed classifier batch sizes, used by the AOTInductor packages and the captured CUDA graphs;
+# the largest must cover BATCH_MAX_SIZE, the row cap of a classifier forward.
+# Packages are built offline by `python export_models.py aot`, one per batch size.
+EFFNET_BATCH_BUCKETS = (1, 4, 8, 16)
+EFFNET_AOT_PATHS = {b: os.path.join(MODEL_DIR, f"effnet_b{b}.pt2") for b in EFFNET_BATCH_BUCKETS}
+# Built offline by `python export_models.py yolo`
+YOLO_ONNX_PATH = os.path.join(MODEL_DIR, "yolov8n_int8.onnx")
+YOLO_INPUT_SIZE = 640
+# ONNX Runtime's TensorRT provider caches the engines it builds for the YOLO model here
+YOLO_TRT_CACHE_DIR = os.path.join(MODEL_DIR, "yolo_trt_cache")
+YOLO_CONF_THRESHOLD = 0.25
+YOLO_IOU_THRESHOLD = 0.45
+FRCNN_SCORE_THRESHOLD = 0.3
+FRCNN_IOU_THRESHOLD = 0.5
+MAX_DETECTIONS = 50
+# Dynamic batching: coalesce requests for up to BATCH_MAX_WAIT_S or BATCH_MAX_SIZE items
+BATCH_MAX_SIZE = 16
+BATCH_MAX_WAIT_S = 0.005
+assert max(EFFNET_BATCH_BUCKETS) >= BATCH_MAX_SIZE, "the largest classifier batch bucket must cover BATCH_MAX_SIZE"
+# Responses memoized by upload content, for clients that retry identical uploads
+CLASSIFY_CACHE_SIZE = int(os.environ.get("CLASSIFY_CACHE_SIZE", "1024"))
+# EfficientNet-B3 ImageNet preprocessing
+EFFNET_CROP_SIZE = 300
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+JPEG_MAGIC = b"\xff\xd8\xff"
+# Largest upload staged through the pinned buffer (4K x 4K RGB); page-locked memory is
+# never returned to the OS, so bigger images take a plain pageable copy
+PINNED_STAGING_MAX_BYTES = 4096 * 4096 * 3
+
+
+def _token_pattern(tokens: List[str]) -> "re.Pattern[str]":
+    """Single alternation matching any token as a substring."""
+    return re.compile("|".join(map(re.escape, tokens)))
+
+
+@dataclass(frozen=True)
+class TokenSets:
+    """Domain and disease heuristics, built once at import.
+
+    The *_labels sets are matched exactly against lower-cased detector labels;
+    the patterns are substring searches over the lower-cased classifier label.
+    """
+
+    animal_labels: FrozenSet[str]
+    plant_labels: FrozenSet[str]
+    fish_labels: FrozenSet[str]
+    fish: "re.Pattern[str]"
+    plant: "re.Pattern[str]"
+    animal: "re.Pattern[str]"
+    disease: "re.Pattern[str]"
+
+
+TOKENS = TokenSets(
+    animal_labels=frozenset({"cow", "sheep", "horse", "dog", "cat", "bird", "zebra", "giraffe", "bear"}),
+    plant_labels=frozenset({"potted plant", "plant"}),
+    fish_labels=frozenset({"fish", "shark", "ray"}),
+    fish=_token_pattern(["shark", "ray", "tench", "goldfish", "salmon", "trout", "tilapia", "cod", "mackerel"]),
+    plant=_token_pattern(["leaf", "plant", "tomato", "potato", "maize", "corn", "wheat", "rice"]),
+    animal=_token_pattern(["cow", "sheep", "horse", "cat", "dog", "tiger", "lion"]),
+    disease=_token_pattern(["blight", "mildew", "rust", "fungus", "spot", "mold"]),
+)
+
+_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class TrtModule:
+    """Callable wrapper running a serialized TensorRT engine on torch CUDA buffers."""
+
+    def __init__(self, engine_path: str, stream: "torch.cuda.Stream"):
+        trt_logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, "rb") as f:
+            self.engine = trt.Runtime(trt_logger).deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = stream
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.input_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+        self.output_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT)
+        # classify_batch sends up to BATCH_MAX_SIZE rows; (min, opt, max) shapes of the first profile
+        max_batch = self.engine.get_tensor_profile_shape(self.input_name, 0)[2][0]
+        if max_batch < BATCH_MAX_SIZE:
+            raise RuntimeError(f"{engine_path} accepts at most {max_batch} rows, rebuild it with --max-batch {BATCH_MAX_SIZE}")
+
+    def __call__(self, tensor: torch.Tensor) -> torch.Tensor:
+        d_input = tensor.to(_device, dtype=torch.float32).contiguous()
+        if not self.context.set_input_shape(self.input_name, tuple(d_input.shape)):
+            raise RuntimeError(f"TensorRT engine rejected input shape {tuple(d_input.shape)}")
+        d_output = torch.empty(tuple(self.context.get_tensor_shape(self.output_name)), device=_device, dtype=torch.float32)
+        self.context.set_tensor_address(self.input_name, d_input.data_ptr())
+        self.context.set_tensor_address(self.output_name, d_output.data_ptr())
+        # The H2D copy above ran on the default stream; order the engine after it
+        self.stream.wait_stream(torch.cuda.current_stream())
+        self.context.execute_async_v3(self.stream.cuda_stream)
+        self.stream.synchronize()
+        return d_output
+
+
+def letterbox(image: torch.Tensor, size: int = YOLO_INPUT_SIZE) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """Resize a uint8 CHW image keeping aspect ratio and pad to a square; returns a 1x3xSxS uint8 array."""
+    height, width = image.shape[-2:]
+    ratio = min(size / width, size / height)
+    # Extreme aspect ratios would otherwise round one side down to zero
+    new_w, new_h = max(1, int(round(width * ratio))), max(1, int(round(height * ratio)))
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+    resized = TF.resize(image, [new_h, new_w], antialias=True)
+    padded = F.pad(resized, (pad_x, size - new_w - pad_x, pad_y, size - new_h - pad_y), value=114)
+    return padded.unsqueeze(0).cpu().numpy(), ratio, (pad_x, pad_y)
+
+
+class OnnxYoloDetector:
+    """YOLOv8 detector served by an ONNX Runtime session (INT8 QDQ export)."""
+
+    def __init__(self, model_path: str):
+        available = ort.get_available_providers()
+        # One profile covering every batch size the batcher can send, so a new batch
+        # size never triggers an engine rebuild on the request path
+        shape = f"images:{{}}x3x{YOLO_INPUT_SIZE}x{YOLO_INPUT_SIZE}"
+        trt_options = {
+            "trt_int8_enable": True,
+            "trt_fp16_enable": True,
+            "trt_profile_min_shapes": shape.format(1),
+            "trt_profile_opt_shapes": shape.format(BATCH_MAX_SIZE),
+            "trt_profile_max_shapes": shape.format(BATCH_MAX_SIZE),
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": YOLO_TRT_CACHE_DIR,
+        }
+        providers = [
+            ("TensorrtExecutionProvider", trt_options),
+            "CUDAExecutionProvider",
+            "CPUExecutionProvider",
+        ]
+        providers = [p for p in providers if (p[0] if isinstance(p, tuple) else p) in available]
+        if "TensorrtExecutionProvider" in available:
+            os.makedirs(YOLO_TRT_CACHE_DIR, exist_ok=True)
+        self.session = ort.InferenceSession(model_path, providers=providers)
+        session_providers = self.session.get_providers()
+        logger.info("YOLO detector running on ONNX Runtime providers %s", session_providers)
+        if _device.type == "cuda" and session_providers == ["CPUExecutionProvider"]:
+            logger.warning("CUDA is available but the YOLO detector runs on CPU; install onnxruntime-gpu in place of onnxruntime")
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_dtype = np.float16 if model_input.type == "tensor(float16)" else np.float32
+        # Ultralytics stores the class names as a dict literal in the model metadata
+        names = self.session.get_modelmeta().custom_metadata_map.get("names")
+        names = ast.literal_eval(names) if names else {}
+        self.labels = tuple(names[i] for i in sorted(names))
+
+    def __call__(self, images: List[torch.Tensor]) -> List[List[Dict[str, Any]]]:
+        letterboxed = [letterbox(image) for image in images]
+        arr = np.concatenate([arr for arr, _, _ in letterboxed])
+        arr = (arr.astype(np.float32) / 255.0).astype(self.input_dtype)
+        outputs = self.session.run(None, {self.input_name: arr})[0]
+        return [
+            self._decode(output, ratio, pad, image.shape[-2:])
+            for output, image, (_, ratio, pad) in zip(outputs, images, letterboxed)
+        ]
+
+    def _decode(self, output: np.ndarray, ratio: float, pad: Tuple[int, int], size: Tuple[int, int]) -> List[Dict[str, Any]]:
+        # (4 + num_classes, anchors) -> (anchors, 4 + num_classes)
+        pred = torch.from_numpy(output).float().T
+        scores, classes = pred[:, 4:].max(dim=1)
+        keep = scores > YOLO_CONF_THRESHOLD
+        pred, scores, classes = pred[keep], scores[keep], classes[keep]
+        boxes = box_convert(pred[:, :4], "cxcywh", "xyxy")
+        # Undo the letterbox transform
+        boxes[:, [0, 2]] -= pad[0]
+        boxes[:, [1, 3]] -= pad[1]
+        boxes /= ratio
+        # Clip to the original image, as torchvision's detectors do
+        height, width = size
+        boxes[:, 0::2].clamp_(0, width)
+        boxes[:, 1::2].clamp_(0, height)
+        keep = batched_nms(boxes, scores, classes, YOLO_IOU_THRESHOLD)[:MAX_DETECTIONS]
+
+        detections: List[Dict[str, Any]] = []
+        for xyxy, conf, cls_idx in zip(boxes[keep].tolist(), scores[keep].tolist(), classes[keep].tolist()):
+            cls_name = self.labels[cls_idx] if cls_idx < len(self.labels) else str(cls_idx)
+            detections.append({
+                "label": cls_name,
+                "confidence": conf,
+                "box": xyxy
+            })
+        return detections
+
+
+def bucket_size(n: int) -> int:
+    """Smallest batch bucket that fits n rows."""
+    return next(b for b in EFFNET_BATCH_BUCKETS if b >= n)
+
+
+class BucketedAotModule:
+    """Dispatches a batch to AOTInductor packages compiled for fixed batch sizes.
+
+    Batches are padded up to the nearest bucket by repeating the last row and the
+    padded outputs are dropped.
+    """
+
+    def __init__(self, paths: Dict[int, str]):
+        from torch._inductor import aoti_load_package
+
+        self.runners = {b: aoti_load_package(path) for b, path in paths.items()}
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        n = len(batch)
+        size = bucket_size(n)
+        if size > n:
+            batch = torch.cat([batch, batch[-1:].expand(size - n, -1, -1, -1)])
+        batch = batch.contiguous(memory_format=torch.channels_last)
+        return self.runners[size](batch)[:n]
+
+
+class CudaGraphModule:
+    """Replays CUDA graphs captured per batch bucket instead of launching each kernel.
+
+    Inputs are copied into the bucket's static buffer; rows past the real batch keep
+    stale data and their outputs are dropped. Replays are serialized on the classifier
+    batcher thread and outputs are cloned right away, so all graphs share the memory
+    pool of the largest one.
+    """
+
+    def __init__(self, module: Callable[[torch.Tensor], torch.Tensor], dtype: torch.dtype):
+        self.graphs: Dict[int, Tuple["torch.cuda.CUDAGraph", torch.Tensor, torch.Tensor]] = {}
+        side = torch.cuda.Stream()
+        pool = None
+        # Largest bucket first, so its pool is big enough for every later capture
+        for size in sorted(EFFNET_BATCH_BUCKETS, reverse=True):
+            static_in = torch.zeros((size, 3, EFFNET_CROP_SIZE, EFFNET_CROP_SIZE), device=_device, dtype=dtype)
+            static_in = static_in.contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                # Compile and autotune on a side stream before capturing, as torch.cuda.graph requires
+                side.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(side):
+                    for _ in range(2):
+                        module(static_in)
+                torch.cuda.current_stream().wait_stream(side)
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph, pool=pool):
+                    static_out = module(static_in)
+            pool = graph.pool() if pool is None else pool
+            self.graphs[size] = (graph, static_in, static_out)
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        n = len(batch)
+        graph, static_in, static_out = self.graphs[bucket_size(n)]
+        static_in[:n].copy_(batch)
+        graph.replay()
+        return static_out[:n].clone()
+
+
+# Models, loaded once by the startup hook
+_detector = None
+_effnet: Optional[Callable[[torch.Tensor], torch.Tensor]] = None
 _effnet_labels: Optional[List[str]] = None
+# Input dtype expected by the active classifier backend
+_effnet_dtype = torch.float32
+# Name of the active classifier backend, reported by /health
+_effnet_backend = "eager"
+# Normalization constants cached on the device
+_effnet_mean = torch.tensor(IMAGENET_MEAN, device=_device).view(1, 3, 1, 1)
+_effnet_std = torch.tensor(IMAGENET_STD, device=_device).view(1, 3, 1, 1)
+# Dedicated CUDA stream for classifier work
+_stream: Optional["torch.cuda.Stream"] = None
+# Reusable pinned host buffer for uploads that are decoded on the CPU
+_pinned: Optional[torch.Tensor] = None
+_pinned_copy_done: Optional["torch.cuda.Event"] = None
 
 
 def load_models():
-    global _detector, _effnet, _effnet_transform, _effnet_labels
-    if _detector is None:
+    global _detector, _effnet, _effnet_labels, _effnet_dtype, _effnet_backend, _stream
+    if ort is not None and os.path.exists(YOLO_ONNX_PATH):
+        _detector = OnnxYoloDetector(YOLO_ONNX_PATH)
+    else:
+        # Fall back to torchvision Faster R-CNN until the YOLO export is present
         try:
             dweights = FasterRCNN_ResNet50_FPN_Weights.COCO_V1
             _detector = fasterrcnn_resnet50_fpn(weights=dweights)
-            _detector.labels = dweights.meta.get("categories", [])
+            _detector.labels = tuple(dweights.meta.get("categories", []))
         except Exception:
             _detector = fasterrcnn_resnet50_fpn(weights=None)
-            _detector.labels = []
+            _detector.labels = ()
         _detector.eval()
-    if _effnet is None:
+        if _device.type == "cuda":
+            _detector = _detector.to(_device, memory_format=torch.channels_last)
+        else:
+            _detector = _detector.to(_device)
+
+    # Autotune convolution kernels per input shape, before the classifier graphs are
+    # captured. Classifier inputs are always 300x300, but the Faster R-CNN fallback
+    # sees a new shape for most uploads.
+    if _device.type == "cuda" and isinstance(_detector, OnnxYoloDetector):
+        torch.backends.cudnn.benchmark = True
+
+    _stream = torch.cuda.Stream() if _device.type == "cuda" else None
+    if trt is not None and _device.type == "cuda" and os.path.exists(EFFNET_ENGINE_PATH):
+        # INT8 engine calibrated from the same ImageNet weights
+        _effnet = TrtModule(EFFNET_ENGINE_PATH, _stream)
+        _effnet_labels = EfficientNet_B3_Weights.IMAGENET1K_V1.meta.get("categories", [])
+        _effnet_backend = "trt_int8"
+    elif _device.type == "cuda" and all(os.path.exists(p) for p in EFFNET_AOT_PATHS.values()):
+        # Ahead-of-time compiled, so no torch.compile warmup at startup
+        _effnet = BucketedAotModule(EFFNET_AOT_PATHS)
+        _effnet_labels = EfficientNet_B3_Weights.IMAGENET1K_V1.meta.get("categories", [])
+        _effnet_dtype = torch.float16
+        _effnet_backend = "aot_fp16"
+    elif USE_INT8_CPU and _device.type == "cpu" and os.path.exists(EFFNET_INT8_CPU_PATH):
+        # Statically quantized and TorchScript-traced; eager INT8 is much slower
+        _effnet = torch.jit.load(EFFNET_INT8_CPU_PATH, map_location="cpu")
+        _effnet_labels = EfficientNet_B3_Weights.IMAGENET1K_V1.meta.get("categories", [])
+        _effnet_backend = "int8_cpu"
+    else:
         try:
             weights = EfficientNet_B3_Weights.IMAGENET1K_V1
             _effnet = efficientnet_b3(weights=weights)
-            _effnet_transform = weights.transforms()
             _effnet_labels = weights.meta.get("categories", [])
         except Exception:
             _effnet = efficientnet_b3(weights=None)
-            _effnet_transform = transforms.Compose([
-                transforms.Resize(300),
-                transforms.CenterCrop(300),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
-            ])
             _effnet_labels = []
         _effnet.eval()
+        if _device.type == "cuda":
+            # NHWC lets cuDNN pick the Tensor Core convolution kernels
+            _effnet = _effnet.to(_device, memory_format=torch.channels_last).half()
+            # Inductor fuses the kernels; the captured graphs remove their launch overhead
+            _effnet = CudaGraphModule(torch.compile(_effnet, fullgraph=True, dynamic=False), torch.float16)
+            _effnet_dtype = torch.float16
+            _effnet_backend = "fp16_cuda_graphs"
+
+
+@contextmanager
+def classifier_context():
+    """Inference mode, FP16 autocast when the classifier runs in half precision and,
+    on CUDA, the classifier stream ordered after work already queued on the current one.
+    """
+    stream = nullcontext()
+    if _stream is not None:
+        _stream.wait_stream(torch.cuda.current_stream())
+        stream = torch.cuda.stream(_stream)
+    with stream, torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=_effnet_dtype == torch.float16):
+        yield
+
+
+@app.on_event("startup")
+def warmup():
+    load_models()
+    if _effnet_backend == "int8_cpu" and isinstance(_detector, OnnxYoloDetector):
+        # Low-batch INT8 latency degrades with intra-op threading. The setting is
+        # process-wide, so only pin it when detection runs on ONNX Runtime's own pool;
+        # the Faster R-CNN fallback needs every thread.
+        torch.set_num_threads(1)
+    _detector_batcher.start()
+    _classifier_batcher.start()
+    # One dummy forward per model through the serving path pays for engine builds (or
+    # cache loads), cuDNN algorithm selection and any remaining lazy initialization
+    # before the first request.
+    _detector_batcher.submit(torch.zeros((3, YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), device=_device, dtype=torch.uint8)).result()
+    dummy = torch.zeros((1, 3, EFFNET_CROP_SIZE, EFFNET_CROP_SIZE), device=_device, dtype=_effnet_dtype)
+    dummy = dummy.contiguous(memory_format=torch.channels_last)
+    _classifier_batcher.submit(dummy).result()
+
+
+def pil_to_device_tensor(image: Image.Image) -> torch.Tensor:
+    """Copy an RGB PIL image to the device as uint8 HWC and permute it to CHW there.
+
+    Unlike ToTensor/pil_to_tensor this makes no host-side CHW or float copy; the
+    float conversion happens on the device where each consumer needs it. On CUDA the
+    pixels are staged through a reusable pinned buffer, up to PINNED_STAGING_MAX_BYTES,
+    so the copy is a true async DMA. Only called from the single preprocessing worker, so the buffer is unshared.
+    """
+    global _pinned, _pinned_copy_done
+    width, height = image.size
+    size = height * width * 3
+    if _device.type != "cuda" or size > PINNED_STAGING_MAX_BYTES:
+        return torch.from_numpy(np.array(image)).to(_device).permute(2, 0, 1)
+    if _pinned is None or _pinned.numel() < size:
+        _pinned = torch.empty(size, dtype=torch.uint8, pin_memory=True)
+    elif _pinned_copy_done is not None:
+        # The previous upload's copy must finish before the buffer is overwritten
+        _pinned_copy_done.synchronize()
+    staging = _pinned[:size].view(height, width, 3)
+    staging.numpy()[...] = np.asarray(image)
+    tensor = staging.to(_device, non_blocking=True)
+    _pinned_copy_done = torch.cuda.Event()
+    _pinned_copy_done.record()
+    return tensor.permute(2, 0, 1)
+
+
+def decode_upload(data: bytes) -> torch.Tensor:
+    """Decode uploaded image bytes into a uint8 RGB CHW tensor on the inference device."""
+    if data[:3] == JPEG_MAGIC:
+        # nvJPEG on CUDA, libjpeg-turbo on CPU
+        buf = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+        try:
+            return decode_jpeg(buf, mode=ImageReadMode.RGB, device=_device)
+        except RuntimeError:
+            # Valid JPEGs the decoder rejects (CMYK, arithmetic coding) still decode in PIL
+            pass
+    return pil_to_device_tensor(Image.open(io.BytesIO(data)).convert("RGB"))
 
 
-def pil_image_from_upload(upload: UploadFile) -> Image.Image:
-    contents = upload.file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
-    return image
-
+def frcnn_detections(outputs: Dict[str, torch.Tensor]) -> List[Dict[str, Any]]:
+    # Filter on the device first, then move everything to the host in one transfer per tensor
+    boxes, labels, scores = outputs["boxes"], outputs["labels"], outputs["scores"]
+    keep = scores > FRCNN_SCORE_THRESHOLD
+    boxes, labels, scores = boxes[keep], labels[keep], scores[keep]
+    keep = nms(boxes, scores, FRCNN_IOU_THRESHOLD)[:MAX_DETECTIONS]
 
-def detect_objects(image: Image.Image) -> List[Dict[str, Any]]:
-    load_models()
-    # Convert PIL to tensor
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-    ])
-    tensor = transform(image)
-    with torch.no_grad():
-        outputs = _detector([tensor])[0]
     detections: List[Dict[str, Any]] = []
-    boxes = outputs.get("boxes")
-    labels = outputs.get("labels")
-    scores = outputs.get("scores")
-    if boxes is not None and labels is not None and scores is not None:
-        for i in range(min(len(boxes), 50)):
-            xyxy = boxes[i].tolist()
-            conf = float(scores[i].item())
-            cls_idx = int(labels[i].item())
-            cls_name = _detector.labels[cls_idx] if hasattr(_detector, 'labels') and cls_idx < len(_detector.labels) else str(cls_idx)
-            detections.append({
-                "label": cls_name,
-                "confidence": conf,
-                "box": xyxy
-            })
+    for xyxy, conf, cls_idx in zip(boxes[keep].tolist(), scores[keep].tolist(), labels[keep].tolist()):
+        cls_name = _detector.labels[cls_idx] if cls_idx < len(_detector.labels) else str(cls_idx)
+        detections.append({
+            "label": cls_name,
+            "confidence": conf,
+            "box": xyxy
+        })
     return detections
 
 
-def classify_crop(image: Image.Image) -> Dict[str, Any]:
-    load_models()
-    # Transform and forward pass
-    tensor = _effnet_transform(image).unsqueeze(0)
+def detect_batch(images: List[torch.Tensor]) -> List[List[Dict[str, Any]]]:
+    if isinstance(_detector, OnnxYoloDetector):
+        return _detector(images)
     with torch.no_grad():
-        logits = _effnet(tensor)
-        probs = F.softmax(logits, dim=1)
-        conf, idx = probs.max(dim=1)
-        conf_val = float(conf.item())
-        idx_val = int(idx.item())
-    label = _effnet_labels[idx_val] if _effnet_labels and idx_val < len(_effnet_labels) else str(idx_val)
-
-    # Return top-3 as well (optional use)
-    top3_conf, top3_idx = torch.topk(probs, k=3, dim=1)
-    top3 = []
-    for c, i in zip(top3_conf[0], top3_idx[0]):
-        li = int(i.item())
-        ln = _effnet_labels[li] if _effnet_labels and li < len(_effnet_labels) else str(li)
-        top3.append({"label": ln, "confidence": float(c.item())})
-
-    return {"label": label, "confidence": conf_val, "top3": top3}
-
-
-def estimate_domain(detections: List[Dict[str, Any]], cls_label: str) -> str:
-    labels = {d["label"].lower() for d in detections}
+        outputs = _detector([image.float().div_(255) for image in images])
+    return [frcnn_detections(output) for output in outputs]
+
+
+async def detect_objects(image: torch.Tensor) -> Tuple[List[Dict[str, Any]], FrozenSet[str]]:
+    """Detections for one image plus the set of their lower-cased labels."""
+    detections = await asyncio.wrap_future(_detector_batcher.submit(image))
+    return detections, frozenset(d["label"].lower() for d in detections)
+
+
+def prepare_crops(image: torch.Tensor, boxes: np.ndarray) -> torch.Tensor:
+    """Crop and resize every region of a uint8 CHW image to one normalized classifier batch.
+
+    A single roi_align call samples all boxes straight from the full image on the device.
+    Sampling and normalization stay in float32, since FP16 cannot represent pixel
+    coordinates above 2048 exactly; only the finished crops take the classifier dtype.
+    """
+    full = image.unsqueeze(0).float().div_(255)
+    # roi_align boxes are (batch_index, x1, y1, x2, y2); everything comes from image 0
+    rois = torch.from_numpy(np.pad(boxes, ((0, 0), (1, 0)))).to(_device, dtype=torch.float32)
+    crops = roi_align(full, rois, output_size=(EFFNET_CROP_SIZE, EFFNET_CROP_SIZE), spatial_scale=1.0, aligned=True)
+    crops = crops.sub_(_effnet_mean).div_(_effnet_std)
+    return crops.to(_effnet_dtype).contiguous(memory_format=torch.channels_last)
+
+
+def classify_batch(batches: List[torch.Tensor]) -> List[List[Dict[str, Any]]]:
+    with classifier_context():
+        # Regions of all coalesced requests are pooled, but each request can carry up to
+        # MAX_DETECTIONS of them, so forwards are capped at BATCH_MAX_SIZE rows
+        batch = torch.cat(batches)
+        logits = torch.cat([_effnet(chunk) for chunk in batch.split(BATCH_MAX_SIZE)]).float()
+        # Softmax is monotonic, so top-k of the logits is top-k of the probabilities;
+        # only the selected entries are normalized (exp(logit - logsumexp))
+        top3_logits, top3_idx = torch.topk(logits, k=3, dim=1)
+        top3_conf = torch.exp(top3_logits - torch.logsumexp(logits, dim=1, keepdim=True))
+    if _stream is not None:
+        _stream.synchronize()
+
+    results: List[Dict[str, Any]] = []
+    # One device-to-host transfer per tensor for the whole batch
+    for confs, idxs in zip(top3_conf.tolist(), top3_idx.tolist()):
+        top3 = []
+        for c, li in zip(confs, idxs):
+            ln = _effnet_labels[li] if _effnet_labels and li < len(_effnet_labels) else str(li)
+            top3.append({"label": ln, "confidence": c})
+        results.append({"label": top3[0]["label"], "confidence": top3[0]["confidence"], "top3": top3})
+
+    # Split back into one list per submission
+    split: List[List[Dict[str, Any]]] = []
+    start = 0
+    for b in batches:
+        split.append(results[start:start + len(b)])
+        start += len(b)
+    return split
+
+
+async def classify_crops(image: torch.Tensor, boxes: np.ndarray) -> List[Dict[str, Any]]:
+    crops = await asyncio.get_running_loop().run_in_executor(_executor, prepare_crops, image, boxes)
+    return await asyncio.wrap_future(_classifier_batcher.submit(crops))
+
+
+_detector_batcher = MicroBatcher(detect_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_S)
+_classifier_batcher = MicroBatcher(classify_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_S)
+# Decode and crop preparation run off the event loop on one worker, so their
+# torch calls stay serialized; model forwards run on the batcher threads
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preprocess")
+
+# Only touched from the event loop, so no lock is needed
+_classify_cache: LRUCache = LRUCache(maxsize=CLASSIFY_CACHE_SIZE)
+
+
+def estimate_domain(labels_lower: FrozenSet[str], cls_label_lower: str) -> str:
     # Heuristics based on YOLO labels or classifier label
-    animal_tokens = {"cow", "sheep", "horse", "dog", "cat", "bird", "zebra", "giraffe", "bear"}
-    plant_tokens = {"potted plant", "plant"}
-    fish_tokens = {"fish", "shark", "ray"}
-
-    if labels & animal_tokens:
+    if not labels_lower.isdisjoint(TOKENS.animal_labels):
         return "livestock"
-    if labels & plant_tokens:
+    if not labels_lower.isdisjoint(TOKENS.plant_labels):
         return "plant"
     # If classifier looks like fish / tiger etc.
-    lower = cls_label.lower()
-    if any(tok in lower for tok in ["shark", "ray", "tench", "goldfish", "salmon", "trout", "tilapia", "cod", "mackerel"]):
+    if TOKENS.fish.search(cls_label_lower):
         return "fish"
-    if any(tok in lower for tok in ["leaf", "plant", "tomato", "potato", "maize", "corn", "wheat", "rice"]):
+    if TOKENS.plant.search(cls_label_lower):
         return "plant"
-    if any(tok in lower for tok in ["cow", "sheep", "horse", "cat", "dog", "tiger", "lion"]):
+    if TOKENS.animal.search(cls_label_lower):
         return "livestock"
     return "plant"  # default to plant for the app
 
@@ -146,7 +579,7 @@ def make_narrative(domain: str, cls_label: str, cls_conf: float, detections: Lis
     pct = int(round(cls_conf * 100))
     if domain == "plant":
         # We do not have disease-specific weights; be transparent yet helpful
-        if any(tok in cls_label.lower() for tok in ["blight", "mildew", "rust", "fungus", "spot"]):
+        if TOKENS.disease.search(cls_label.lower()):
             return f"This plant shows signs of {cls_label}. Confidence {pct}%. Consider isolating the affected area and applying appropriate treatment."
         return f"This appears to be a healthy plant or foliage ({cls_label}). Confidence {pct}%."
     if domain == "livestock":
@@ -158,15 +591,14 @@ def make_narrative(domain: str, cls_label: str, cls_conf: float, detections: Lis
 
 @app.get("/health")
 def health():
-    load_models()
     return {"success": True, "message": "AgriCLIP service running", "models": {
-        "detector": "fasterrcnn_resnet50_fpn_coco",
-        "classifier": "efficientnet_b3_imagenet",
+        "detector": "yolov8n_int8_onnx" if isinstance(_detector, OnnxYoloDetector) else "fasterrcnn_resnet50_fpn_coco",
+        "classifier": "efficientnet_b3_imagenet" if _effnet_backend == "eager" else f"efficientnet_b3_imagenet_{_effnet_backend}",
     }}
 
 
 @app.post("/classify")
-def classify(
+async def classify(
     file: UploadFile = File(...),
     uploadId: Optional[str] = Form(None),
     imageDomain: Optional[str] = Form(None),
@@ -177,33 +609,36 @@ def classify(
 ):
     start = time.time()
     try:
-        pil_img = pil_image_from_upload(file)
-        width, height = pil_img.size
+        contents = await file.read()
+        cache_key = (content_hasher(contents).hexdigest(), imageDomain, cropType)
+        cached = _classify_cache.get(cache_key)
+        if cached is not None:
+            # Copy rather than mutate the cached payload; only processingTime is per request
+            classification = {**cached["data"]["classification"], "processingTime": int(round((time.time() - start) * 1000))}
+            return ORJSONResponse({**cached, "data": {**cached["data"], "classification": classification}})
+
+        image = await asyncio.get_running_loop().run_in_executor(_executor, decode_upload, contents)
+        height, width = image.shape[-2:]
 
-        # Object detection (Faster R-CNN)
-        detections = detect_objects(pil_img)
+        # Object detection (YOLOv8, or Faster R-CNN fallback)
+        detections, labels_lower = await detect_objects(image)
 
         # Fallback region: whole image if no detections
-        regions: List[Image.Image] = []
-        boxes_for_regions: List[List[float]] = []
         if detections:
-            for det in detections:
-                x1, y1, x2, y2 = det["box"]
-                x1 = max(0, int(x1)); y1 = max(0, int(y1))
-                x2 = min(width, int(x2)); y2 = min(height, int(y2))
-                crop = pil_img.crop((x1, y1, x2, y2))
-                regions.append(crop)
-                boxes_for_regions.append([x1, y1, x2, y2])
+            # (N, 4) x1, y1, x2, y2; int32 truncates toward zero like int()
+            boxes_arr = np.asarray([det["box"] for det in detections], dtype=np.float64).astype(np.int32)
+            np.maximum(boxes_arr[:, :2], 0, out=boxes_arr[:, :2])
+            np.minimum(boxes_arr[:, 2], width, out=boxes_arr[:, 2])
+            np.minimum(boxes_arr[:, 3], height, out=boxes_arr[:, 3])
         else:
-            regions = [pil_img]
-            boxes_for_regions = [[0, 0, width, height]]
+            boxes_arr = np.array([[0, 0, width, height]], dtype=np.int32)
+        boxes_for_regions = boxes_arr.tolist()
 
         # Classify each region and pick the best
         classified_regions = []
         best_idx = 0
         best_conf = -1.0
-        for i, region in enumerate(regions):
-            cls = classify_crop(region)
+        for i, cls in enumerate(await classify_crops(image, boxes_arr)):
             entry = {
                 "label": cls["label"],
                 "confidence": cls["confidence"],
@@ -217,16 +652,16 @@ def classify(
 
         # Determine domain
         primary_label = classified_regions[best_idx]["label"]
-        domain = imageDomain or estimate_domain(detections, primary_label)
+        lower_label = primary_label.lower()
+        domain = imageDomain or estimate_domain(labels_lower, lower_label)
 
         # Compute affected area as sum of region areas for plants
         affected_area_pct = None
         if domain == "plant":
             total_area = width * height
-            region_area = 0
-            for box in boxes_for_regions:
-                x1, y1, x2, y2 = box
-                region_area += max(0, (x2 - x1)) * max(0, (y2 - y1))
+            w = np.clip(boxes_arr[:, 2] - boxes_arr[:, 0], 0, None).astype(np.int64)
+            h = np.clip(boxes_arr[:, 3] - boxes_arr[:, 1], 0, None).astype(np.int64)
+            region_area = int((w * h).sum())
             if total_area > 0:
                 affected_area_pct = int(round(100 * region_area / total_area))
 
@@ -241,9 +676,7 @@ def classify(
                 severity = "low"
 
         # Decide diseaseDetected and diseaseName
-        lower_label = primary_label.lower()
-        disease_tokens = ["blight", "mildew", "rust", "fungus", "spot", "mold"]
-        disease_detected = any(tok in lower_label for tok in disease_tokens) if domain == "plant" else False
+        disease_detected = bool(TOKENS.disease.search(lower_label)) if domain == "plant" else False
         disease_name = primary_label if disease_detected else (primary_label if domain != "plant" else "Healthy")
 
         # Friendly narrative
@@ -276,7 +709,7 @@ def classify(
 
         processing_time = int(round((time.time() - start) * 1000))
 
-        return JSONResponse({
+        payload = {
             "success": True,
             "message": "Classification completed",
             "data": {
@@ -294,9 +727,11 @@ def classify(
                 "detections": detections,
                 "regions": classified_regions,
             }
-        })
+        }
+        _classify_cache[cache_key] = payload
+        return ORJSONResponse(payload)
     except Exception as e:
-        return JSONResponse(status_code=500, content={
+        return ORJSONResponse(status_code=500, content={
             "success": False,
             "message": "Error during classification",
             "detail": str(e)
@@ -0,0 +1,51 @@
+import pytest
+
+from batching import MicroBatcher
+
+TIMEOUT_S = 5
+
+
+def doubling_batcher(calls, max_batch=4):
+    def run_batch(items):
+        calls.append(list(items))
+        if any(item < 0 for item in items):
+            raise ValueError("negative item")
+        return [item * 2 for item in items]
+
+    return MicroBatcher(run_batch, max_batch=max_batch, max_wait=0.05)
+
+
+def test_coalesces_up_to_max_batch():
+    calls = []
+    batcher = doubling_batcher(calls)
+    # Queue everything before the worker starts so the grouping is deterministic
+    futures = [batcher.submit(i) for i in range(10)]
+    batcher.start()
+
+    assert [f.result(TIMEOUT_S) for f in futures] == [i * 2 for i in range(10)]
+    assert [len(batch) for batch in calls] == [4, 4, 2]
+
+
+def test_cancelled_future_is_dropped_and_worker_survives():
+    calls = []
+    batcher = doubling_batcher(calls)
+    cancelled = batcher.submit(1)
+    assert cancelled.cancel()
+    batcher.start()
+
+    assert batcher.submit(2).result(TIMEOUT_S) == 4
+    assert calls == [[2]]
+
+
+def test_failing_item_only_fails_its_own_future():
+    calls = []
+    batcher = doubling_batcher(calls)
+    good, bad, other = batcher.submit(1), batcher.submit(-1), batcher.submit(3)
+    batcher.start()
+
+    assert good.result(TIMEOUT_S) == 2
+    assert other.result(TIMEOUT_S) == 6
+    with pytest.raises(ValueError):
+        bad.result(TIMEOUT_S)
+    # The failed batch was retried item by item
+    assert calls == [[1, -1, 3], [1], [-1], [3]]